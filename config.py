@@ -7,6 +7,8 @@ from pathlib import Path
 # 服务配置
 HOST = os.getenv("WATERMARK_HOST", "0.0.0.0")
 PORT = int(os.getenv("WATERMARK_PORT", "9996"))
+# 代码热重载（仅用于开发环境）
+RELOAD = os.getenv("WATERMARK_RELOAD", "false").lower() in ("1", "true", "yes")
 
 # 下载URL前缀配置
 DOWNLOAD_URL_PREFIX = os.getenv("DOWNLOAD_URL_PREFIX", "http://121.229.205.96:9996/download")
@@ -20,16 +22,37 @@ TEMP_DIR = BASE_DIR / "temp"
 OUTPUT_DIR.mkdir(exist_ok=True)
 TEMP_DIR.mkdir(exist_ok=True)
 
-# 线程池配置
+# 临时文件按文件名前两位十六进制分散到 256 个子目录，避免单个目录文件过多
+for _shard in range(256):
+    (TEMP_DIR / f"{_shard:02x}").mkdir(exist_ok=True)
+
+# 进程池配置（水印处理为CPU密集型，使用进程池绕开GIL）
 MAX_WORKERS = int(os.getenv("MAX_WORKERS", "10"))
+# 图片水印耗时短，使用较大的进程池；PDF/Word 耗时长，单独使用较小的进程池
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", str(min(MAX_WORKERS, os.cpu_count() or 1))))
+DOC_WORKERS = int(os.getenv("DOC_WORKERS", str(max(1, IMAGE_WORKERS // 2))))
+# PDF 分块并行处理（默认关闭，0 表示不分块）：页数超过该值时按块拆分到多个进程处理，每块至少包含该页数
+# 注意：分块拼接后的PDF不保留原文件的书签、链接、命名目标与表单域
+PDF_CHUNK_PAGES = int(os.getenv("PDF_CHUNK_PAGES", "0"))
+
+# 最大并发下载数（URL方式）
+MAX_DOWNLOADS = int(os.getenv("MAX_DOWNLOADS", "16"))
+
+# 异步任务记录上限（超出后淘汰最早的任务）
+MAX_TASKS = int(os.getenv("MAX_TASKS", "10000"))
+
+# 异步任务状态数据库（SQLite，多个 worker 进程共享）
+TASK_DB_PATH = Path(os.getenv("TASK_DB_PATH", str(BASE_DIR / "tasks.db")))
 
 # 支持的文件类型
-SUPPORTED_IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".bmp", ".webp", ".tiff"}
-SUPPORTED_DOCUMENT_EXTENSIONS = {".pdf", ".docx", ".doc"}
+SUPPORTED_IMAGE_EXTENSIONS = frozenset({".jpg", ".jpeg", ".png", ".gif", ".bmp", ".webp", ".tiff"})
+SUPPORTED_DOCUMENT_EXTENSIONS = frozenset({".pdf", ".docx", ".doc"})
 SUPPORTED_EXTENSIONS = SUPPORTED_IMAGE_EXTENSIONS | SUPPORTED_DOCUMENT_EXTENSIONS
 
 # 文件大小限制 (50MB)
 MAX_FILE_SIZE = int(os.getenv("MAX_FILE_SIZE", str(50 * 1024 * 1024)))
+# URL下载大小上限（字节），超过时中止下载，默认与 MAX_FILE_SIZE 相同
+MAX_DOWNLOAD_BYTES = int(os.getenv("MAX_DOWNLOAD_BYTES", str(MAX_FILE_SIZE)))
 
 # 文件保留时间 (秒)
 FILE_RETENTION_SECONDS = int(os.getenv("FILE_RETENTION_SECONDS", "3600"))
@@ -44,6 +67,12 @@ DEFAULT_WATERMARK_CONFIG = {
     "position": "tile",  # tile(平铺), center(居中), corner(角落)
 }
 
+# 水印层缓存容量（字节，每个工作进程独立）
+OVERLAY_CACHE_BYTES = int(os.getenv("OVERLAY_CACHE_BYTES", str(64 * 1024 * 1024)))
+
+# JPEG 输出质量
+JPEG_QUALITY = int(os.getenv("JPEG_QUALITY", "85"))
+
 # 自定义字体路径（可选，用于支持特定中文字体）
 # 如果设置，将优先使用此字体
 CUSTOM_FONT_PATH = os.getenv("CUSTOM_FONT_PATH", "")
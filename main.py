@@ -2,11 +2,17 @@
 FastAPI 水印服务主入口
 支持图片和文档水印处理
 """
+import glob
+import math
+import time
 import uuid
 import asyncio
+import logging
+import multiprocessing
 from pathlib import Path
 from typing import Optional
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from contextlib import asynccontextmanager
 
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException, BackgroundTasks
@@ -20,24 +26,73 @@ from models import (
 )
 from utils.file_handler import (
     download_file, detect_file_type, get_file_extension,
-    generate_output_filename, save_output_file, get_download_url,
-    cleanup_old_files
+    generate_output_filename, get_download_url,
+    cleanup_old_files, save_upload_to_temp, FileTooLargeError, close_client,
+    _new_temp_path
 )
-from services.watermark_service import add_watermark
+from utils.task_store import TaskStore
+from services.watermark_service import (
+    process_watermark_sync, process_pdf_chunk_sync, concat_pdf_files,
+    count_pdf_pages, warm_up, FileSource
+)
+
 
+logger = logging.getLogger(__name__)
+
+# 进程池（图片与文档分开，避免耗时的文档任务阻塞图片任务）
+# 工作进程启动时预热字体缓存；使用 forkserver 启动，避免从已运行事件循环与线程的进程中 fork
+POOL_WORKERS = {"image": config.IMAGE_WORKERS, "doc": config.DOC_WORKERS}
+_POOL_CONTEXT = multiprocessing.get_context(
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+)
+_pools = {}
 
-# 线程池
-thread_pool = ThreadPoolExecutor(max_workers=config.MAX_WORKERS)
 
-# 任务存储
-tasks: dict = {}
+def get_pool(kind: str) -> ProcessPoolExecutor:
+    """获取进程池（image/doc），首次使用或损坏后重新创建"""
+    pool = _pools.get(kind)
+    if pool is None:
+        pool = _pools[kind] = ProcessPoolExecutor(
+            max_workers=POOL_WORKERS[kind],
+            mp_context=_POOL_CONTEXT,
+            initializer=warm_up
+        )
+    return pool
+
+
+async def run_in_pool(kind: str, func, *args):
+    """
+    在进程池中执行函数
+    工作进程异常退出（如被OOM终止）会使整个进程池失效，此时重建进程池，仅当前请求失败
+    """
+    pool = get_pool(kind)
+    try:
+        return await asyncio.get_running_loop().run_in_executor(pool, func, *args)
+    except BrokenProcessPool:
+        if _pools.get(kind) is pool:
+            del _pools[kind]
+            pool.shutdown(wait=False)
+        raise RuntimeError("水印处理进程异常退出")
+
+# 并发下载限制
+download_semaphore = asyncio.Semaphore(config.MAX_DOWNLOADS)
+
+# 任务存储（SQLite，多个 worker 进程共享，已结束的任务按保留时间过期）
+task_store = TaskStore(
+    config.TASK_DB_PATH,
+    ttl_seconds=config.FILE_RETENTION_SECONDS,
+    max_tasks=config.MAX_TASKS
+)
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """应用生命周期管理"""
     # 启动时清理旧文件
-    cleanup_old_files()
+    await cleanup_old_files()
+    
+    # 启动时预先扫描系统字体
+    await asyncio.to_thread(scan_system_fonts)
     
     # 启动定时清理任务
     cleanup_task = asyncio.create_task(periodic_cleanup())
@@ -46,14 +101,24 @@ async def lifespan(app: FastAPI):
     
     # 关闭时清理
     cleanup_task.cancel()
-    thread_pool.shutdown(wait=False)
+    for pool in _pools.values():
+        pool.shutdown(wait=False)
+    await close_client()
 
 
 async def periodic_cleanup():
     """定期清理过期文件"""
     while True:
         await asyncio.sleep(300)  # 每5分钟清理一次
-        cleanup_old_files()
+        # 单次清理失败（如数据库被锁）只记录日志，不终止清理循环
+        try:
+            await cleanup_old_files()
+        except Exception:
+            logger.exception("清理过期文件失败")
+        try:
+            await asyncio.to_thread(task_store.cleanup_expired)
+        except Exception:
+            logger.exception("清理过期任务失败")
 
 
 app = FastAPI(
@@ -73,39 +138,84 @@ app.add_middleware(
 )
 
 
-def process_watermark_sync(
-    file_data: bytes,
-    text: str,
-    file_type: str,
-    file_extension: str,
-    watermark_config: WatermarkConfig
-) -> bytes:
-    """同步处理水印（在线程池中执行）"""
-    return add_watermark(
-        file_data=file_data,
-        text=text,
-        file_type=file_type,
-        config=watermark_config,
-        file_extension=file_extension
-    )
+# 显式指定的文件类型 -> 处理类型（AUTO 需根据扩展名检测）
+_FILE_TYPE_DISPATCH = {
+    FileType.IMAGE: "image",
+    FileType.PDF: "pdf",
+    FileType.WORD: "word",
+}
+
+
+def resolve_file_type(file_type: FileType, extension: str) -> str:
+    """确定实际处理的文件类型，无法识别时返回 unknown"""
+    return _FILE_TYPE_DISPATCH.get(file_type) or detect_file_type(extension)
 
 
 async def process_watermark_async(
-    file_data: bytes,
+    file_data: FileSource,
     text: str,
     file_type: str,
     file_extension: str,
-    watermark_config: WatermarkConfig
-) -> bytes:
-    """异步处理水印"""
-    loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(
-        thread_pool,
+    watermark_config: WatermarkConfig,
+    output_filename: str
+) -> Path:
+    """异步处理水印，结果直接写入输出目录"""
+    output_path = config.OUTPUT_DIR / output_filename
+    
+    # 页数较多的PDF拆分为多个分块并行处理（需通过 PDF_CHUNK_PAGES 显式开启）
+    if file_type == "pdf" and config.PDF_CHUNK_PAGES > 0 and config.DOC_WORKERS > 1:
+        page_count = await run_in_pool("doc", count_pdf_pages, file_data)
+        if page_count > config.PDF_CHUNK_PAGES:
+            return await process_pdf_parallel(
+                file_data, text, watermark_config, page_count, output_path
+            )
+    
+    return await run_in_pool(
+        "image" if file_type == "image" else "doc",
         process_watermark_sync,
-        file_data, text, file_type, file_extension, watermark_config
+        file_data, text, file_type, file_extension,
+        watermark_config.model_dump(mode="json"),
+        output_path
     )
 
 
+async def process_pdf_parallel(
+    file_data: FileSource,
+    text: str,
+    watermark_config: WatermarkConfig,
+    page_count: int,
+    output_path: Path
+) -> Path:
+    """将PDF按页拆分为多个分块，在进程池中并行添加水印后按顺序拼接"""
+    chunk_size = max(config.PDF_CHUNK_PAGES, math.ceil(page_count / config.DOC_WORKERS))
+    ranges = [
+        (start, min(start + chunk_size, page_count))
+        for start in range(0, page_count, chunk_size)
+    ]
+    
+    part_paths = [_new_temp_path(f"_part{i}.pdf") for i in range(len(ranges))]
+    watermark_config_data = watermark_config.model_dump(mode="json")
+    try:
+        # 等待所有分块结束后再清理，避免仍在运行的分块在清理后写入临时文件
+        results = await asyncio.gather(*(
+            run_in_pool(
+                "doc",
+                process_pdf_chunk_sync,
+                file_data, text, start, stop, part_path, watermark_config_data
+            )
+            for (start, stop), part_path in zip(ranges, part_paths)
+        ), return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        return await run_in_pool(
+            "doc", concat_pdf_files, part_paths, output_path, file_data
+        )
+    finally:
+        for part_path in part_paths:
+            part_path.unlink(missing_ok=True)
+
+
 @app.post("/api/watermark/url", response_model=WatermarkResponse, summary="URL方式添加水印")
 async def add_watermark_by_url(request: WatermarkRequest):
     """
@@ -116,38 +226,38 @@ async def add_watermark_by_url(request: WatermarkRequest):
     - **file_type**: 文件类型 (auto/image/pdf/word)
     - **config**: 水印配置（可选）
     """
+    temp_path = None
     try:
-        # 下载文件
-        file_data, original_filename, extension = await download_file(str(request.url))
+        # 下载文件到临时目录（限制并发下载数）
+        try:
+            async with download_semaphore:
+                temp_path, original_filename, extension = await download_file(str(request.url))
+        except FileTooLargeError:
+            raise HTTPException(status_code=413, detail="文件大小超过限制")
         
         # 检查文件大小
-        if len(file_data) > config.MAX_FILE_SIZE:
+        if temp_path.stat().st_size > config.MAX_FILE_SIZE:
             raise HTTPException(status_code=413, detail="文件大小超过限制")
         
         # 确定文件类型
-        if request.file_type == FileType.AUTO:
-            file_type = detect_file_type(extension)
-            if file_type == "unknown":
-                raise HTTPException(status_code=400, detail=f"不支持的文件类型: {extension}")
-        else:
-            file_type = request.file_type.value
+        file_type = resolve_file_type(request.file_type, extension)
+        if file_type == "unknown":
+            raise HTTPException(status_code=400, detail=f"不支持的文件类型: {extension}")
         
         # 获取水印配置
         watermark_config = request.config or WatermarkConfig()
         
-        # 处理水印
-        result_data = await process_watermark_async(
-            file_data=file_data,
+        # 处理水印，结果直接写入输出文件
+        output_filename = generate_output_filename(original_filename)
+        await process_watermark_async(
+            file_data=temp_path,
             text=request.watermark_text,
             file_type=file_type,
             file_extension=extension,
-            watermark_config=watermark_config
+            watermark_config=watermark_config,
+            output_filename=output_filename
         )
         
-        # 保存输出文件
-        output_filename = generate_output_filename(original_filename)
-        save_output_file(result_data, output_filename)
-        
         # 生成下载URL
         download_url = get_download_url(output_filename)
         
@@ -162,6 +272,10 @@ async def add_watermark_by_url(request: WatermarkRequest):
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"处理失败: {str(e)}")
+    finally:
+        # 清理临时文件
+        if temp_path is not None:
+            temp_path.unlink(missing_ok=True)
 
 
 @app.post("/api/watermark/file", response_model=WatermarkResponse, summary="文件上传方式添加水印")
@@ -183,26 +297,22 @@ async def add_watermark_by_file(
     - 图片: jpg, jpeg, png, gif, bmp, webp, tiff
     - 文档: pdf, docx
     """
+    temp_path = None
     try:
-        # 读取文件内容
-        file_data = await file.read()
-        
-        # 检查文件大小
-        if len(file_data) > config.MAX_FILE_SIZE:
-            raise HTTPException(status_code=413, detail="文件大小超过限制")
-        
         # 获取文件扩展名
         original_filename = file.filename or "unknown"
         extension = get_file_extension(original_filename)
         
         # 确定文件类型
-        if file_type == FileType.AUTO:
-            detected_type = detect_file_type(extension)
-            if detected_type == "unknown":
-                raise HTTPException(status_code=400, detail=f"不支持的文件类型: {extension}")
-            actual_file_type = detected_type
-        else:
-            actual_file_type = file_type.value
+        actual_file_type = resolve_file_type(file_type, extension)
+        if actual_file_type == "unknown":
+            raise HTTPException(status_code=400, detail=f"不支持的文件类型: {extension}")
+        
+        # 分块写入临时文件，同时检查文件大小
+        try:
+            temp_path = await save_upload_to_temp(file, extension)
+        except FileTooLargeError:
+            raise HTTPException(status_code=413, detail="文件大小超过限制")
         
         # 构建水印配置
         from models import WatermarkPosition
@@ -215,19 +325,17 @@ async def add_watermark_by_file(
             position=WatermarkPosition(position)
         )
         
-        # 处理水印
-        result_data = await process_watermark_async(
-            file_data=file_data,
+        # 处理水印，结果直接写入输出文件
+        output_filename = generate_output_filename(original_filename)
+        await process_watermark_async(
+            file_data=temp_path,
             text=watermark_text,
             file_type=actual_file_type,
             file_extension=extension,
-            watermark_config=watermark_config
+            watermark_config=watermark_config,
+            output_filename=output_filename
         )
         
-        # 保存输出文件
-        output_filename = generate_output_filename(original_filename)
-        save_output_file(result_data, output_filename)
-        
         # 生成下载URL
         download_url = get_download_url(output_filename)
         
@@ -242,6 +350,10 @@ async def add_watermark_by_file(
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"处理失败: {str(e)}")
+    finally:
+        # 清理临时文件
+        if temp_path is not None:
+            temp_path.unlink(missing_ok=True)
 
 
 @app.post("/api/watermark/async", response_model=TaskResponse, summary="异步任务方式添加水印")
@@ -255,11 +367,7 @@ async def add_watermark_async(
     task_id = uuid.uuid4().hex
     
     # 初始化任务状态
-    tasks[task_id] = {
-        "status": TaskStatus.PENDING,
-        "message": "任务已创建",
-        "download_url": None
-    }
+    await asyncio.to_thread(task_store.create, task_id, TaskStatus.PENDING, "任务已创建")
     
     # 添加后台任务
     background_tasks.add_task(
@@ -277,51 +385,51 @@ async def add_watermark_async(
 
 async def process_watermark_task(task_id: str, request: WatermarkRequest):
     """后台处理水印任务"""
+    temp_path = None
     try:
-        tasks[task_id]["status"] = TaskStatus.PROCESSING
-        tasks[task_id]["message"] = "正在处理中..."
+        await asyncio.to_thread(task_store.update, task_id, TaskStatus.PROCESSING, "正在处理中...")
         
-        # 下载文件
-        file_data, original_filename, extension = await download_file(str(request.url))
+        # 下载文件到临时目录（限制并发下载数）
+        async with download_semaphore:
+            temp_path, original_filename, extension = await download_file(str(request.url))
         
         # 确定文件类型
-        if request.file_type == FileType.AUTO:
-            file_type = detect_file_type(extension)
-        else:
-            file_type = request.file_type.value
+        file_type = resolve_file_type(request.file_type, extension)
         
         watermark_config = request.config or WatermarkConfig()
         
-        # 处理水印
-        result_data = await process_watermark_async(
-            file_data=file_data,
+        # 处理水印，结果直接写入输出文件
+        output_filename = generate_output_filename(original_filename)
+        await process_watermark_async(
+            file_data=temp_path,
             text=request.watermark_text,
             file_type=file_type,
             file_extension=extension,
-            watermark_config=watermark_config
+            watermark_config=watermark_config,
+            output_filename=output_filename
         )
         
-        # 保存输出文件
-        output_filename = generate_output_filename(original_filename)
-        save_output_file(result_data, output_filename)
-        
         # 更新任务状态
-        tasks[task_id]["status"] = TaskStatus.COMPLETED
-        tasks[task_id]["message"] = "处理完成"
-        tasks[task_id]["download_url"] = get_download_url(output_filename)
+        await asyncio.to_thread(
+            task_store.update, task_id, TaskStatus.COMPLETED, "处理完成",
+            download_url=get_download_url(output_filename)
+        )
         
     except Exception as e:
-        tasks[task_id]["status"] = TaskStatus.FAILED
-        tasks[task_id]["message"] = f"处理失败: {str(e)}"
+        await asyncio.to_thread(task_store.update, task_id, TaskStatus.FAILED, f"处理失败: {str(e)}")
+    finally:
+        # 清理临时文件
+        if temp_path is not None:
+            temp_path.unlink(missing_ok=True)
 
 
 @app.get("/api/task/{task_id}", response_model=TaskResponse, summary="查询任务状态")
 async def get_task_status(task_id: str):
     """查询异步任务的处理状态"""
-    if task_id not in tasks:
+    task = await asyncio.to_thread(task_store.get, task_id)
+    if task is None:
         raise HTTPException(status_code=404, detail="任务不存在")
     
-    task = tasks[task_id]
     return TaskResponse(
         task_id=task_id,
         status=task["status"],
@@ -355,6 +463,9 @@ async def get_config():
         "supported_image_formats": list(config.SUPPORTED_IMAGE_EXTENSIONS),
         "supported_document_formats": list(config.SUPPORTED_DOCUMENT_EXTENSIONS),
         "max_workers": config.MAX_WORKERS,
+        "max_downloads": config.MAX_DOWNLOADS,
+        "image_workers": config.IMAGE_WORKERS,
+        "doc_workers": config.DOC_WORKERS,
         "download_url_prefix": config.DOWNLOAD_URL_PREFIX
     }
 
@@ -365,14 +476,38 @@ async def health_check():
     return {"status": "healthy", "service": "watermark-service"}
 
 
+# 系统字体扫描结果缓存，避免每次请求都递归遍历字体目录
+FONT_SCAN_TTL_SECONDS = 300
+_font_scan_cache: dict = {"scanned_at": None, "fonts": []}
+
+
+def scan_system_fonts() -> list:
+    """列出 /usr/share/fonts 下所有文件（结果缓存 FONT_SCAN_TTL_SECONDS 秒）"""
+    now = time.monotonic()
+    scanned_at = _font_scan_cache["scanned_at"]
+    if scanned_at is not None and now - scanned_at < FONT_SCAN_TTL_SECONDS:
+        return _font_scan_cache["fonts"]
+    
+    try:
+        all_fonts = glob.glob("/usr/share/fonts/**/*", recursive=True)
+        fonts = [f for f in all_fonts if Path(f).is_file()]
+    except Exception as e:
+        fonts = [f"Error: {e}"]
+    
+    _font_scan_cache["scanned_at"] = now
+    _font_scan_cache["fonts"] = fonts
+    return fonts
+
+
 @app.get("/api/debug/fonts", summary="字体诊断")
 async def debug_fonts():
     """检查可用字体"""
-    import glob
-    from pathlib import Path
-    from services.watermark_service import CHINESE_FONT_PATHS, _find_cjk_fonts
+    from services.watermark_service import (
+        CHINESE_FONT_PATHS, _RESOLVED_FONT_PATH, _find_cjk_fonts
+    )
     
     results = {
+        "resolved_font": _RESOLVED_FONT_PATH,
         "predefined_fonts": {},
         "dynamic_fonts": [],
         "all_fonts_in_system": []
@@ -385,12 +520,8 @@ async def debug_fonts():
     # 动态查找的字体
     results["dynamic_fonts"] = _find_cjk_fonts()
     
-    # 列出 /usr/share/fonts 下所有文件
-    try:
-        all_fonts = glob.glob("/usr/share/fonts/**/*", recursive=True)
-        results["all_fonts_in_system"] = [f for f in all_fonts if Path(f).is_file()]
-    except Exception as e:
-        results["all_fonts_in_system"] = [f"Error: {e}"]
+    # 列出 /usr/share/fonts 下所有文件（缓存过期时在线程中重新扫描）
+    results["all_fonts_in_system"] = await asyncio.to_thread(scan_system_fonts)
     
     return results
 
@@ -401,5 +532,8 @@ if __name__ == "__main__":
         "main:app",
         host=config.HOST,
         port=config.PORT,
-        reload=True
+        # uvicorn[standard] 自带 uvloop/httptools，auto 模式下会优先使用（Windows 不支持 uvloop）
+        loop="auto",
+        http="auto",
+        reload=config.RELOAD
     )
@@ -2,17 +2,22 @@
 水印服务 - 支持图片、PDF、Word文档
 """
 import io
-import glob
+import os
 import math
 import logging
+import functools
+import threading
 from pathlib import Path
-from typing import Optional, Tuple
+from types import MappingProxyType
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import BinaryIO, Optional, Tuple, Union
 from PIL import Image, ImageDraw, ImageFont, ImageEnhance
 from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import letter
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
-from PyPDF2 import PdfReader, PdfWriter
+from pypdf import PdfReader, PdfWriter
 from docx import Document
 from lxml import etree
 
@@ -20,10 +25,21 @@ import config as app_config
 from models import WatermarkConfig, WatermarkPosition
 
 
+# 文件来源: 内存中的二进制数据，或已落盘的文件路径
+FileSource = Union[bytes, Path]
+
+
+def _open_source(source: FileSource):
+    """将文件来源转换为可供 PIL / pypdf / python-docx 读取的对象"""
+    if isinstance(source, (bytes, bytearray)):
+        return io.BytesIO(source)
+    return str(source)
+
+
 def hex_to_rgb(hex_color: str) -> Tuple[int, int, int]:
     """HEX颜色转RGB"""
-    hex_color = hex_color.lstrip("#")
-    return tuple(int(hex_color[i:i+2], 16) for i in (0, 2, 4))
+    r, g, b = bytes.fromhex(hex_color.lstrip("#")[:6])
+    return (r, g, b)
 
 
 def hex_to_rgba(hex_color: str, opacity: float) -> Tuple[int, int, int, int]:
@@ -33,6 +49,30 @@ def hex_to_rgba(hex_color: str, opacity: float) -> Tuple[int, int, int, int]:
     return (r, g, b, a)
 
 
+# 图片扩展名 -> 输出格式
+_IMG_FORMAT_BY_EXT = MappingProxyType({
+    ".jpg": "JPEG",
+    ".jpeg": "JPEG",
+    ".png": "PNG",
+    ".gif": "GIF",
+    ".bmp": "BMP",
+    ".webp": "WEBP",
+    ".tiff": "TIFF",
+})
+
+# 不支持透明通道的输出格式
+OPAQUE_IMAGE_FORMATS = frozenset({"JPEG", "BMP"})
+
+
+# 平铺水印层缓存的尺寸分档（像素）
+OVERLAY_SIZE_BUCKET = 256
+
+# 水印层缓存: (尺寸, 文字, 配置...) -> RGBA 图层，按最近使用顺序排列
+_overlay_cache: "OrderedDict[tuple, Image.Image]" = OrderedDict()
+_overlay_cache_bytes = 0
+_overlay_cache_lock = threading.Lock()
+
+
 # 全局字体路径配置（支持中文）
 CHINESE_FONT_PATHS = [
     # Docker 容器内置字体（优先，TTF格式兼容reportlab）
@@ -51,56 +91,103 @@ CHINESE_FONT_PATHS = [
 ]
 
 
+# 动态查找字体的目录与扩展名
+SYSTEM_FONT_DIR = "/usr/share/fonts"
+FONT_FILE_EXTENSIONS = frozenset({".otf", ".ttf", ".ttc"})
+
+
 # 配置日志
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-def _find_cjk_fonts() -> list:
-    """动态查找系统中的 CJK 字体"""
-    patterns = [
-        "/usr/share/fonts/**/*.otf",
-        "/usr/share/fonts/**/*.ttf",
-        "/usr/share/fonts/**/*.ttc",
-    ]
+@functools.lru_cache(maxsize=1)
+def _find_cjk_fonts() -> tuple:
+    """动态查找系统中的 CJK 字体（结果缓存，进程内只扫描一次）"""
+    # 一次遍历目录树，按扩展名筛选
     found = []
-    for pattern in patterns:
-        found.extend(glob.glob(pattern, recursive=True))
+    for root, _, files in os.walk(SYSTEM_FONT_DIR):
+        for name in files:
+            if os.path.splitext(name)[1].lower() in FONT_FILE_EXTENSIONS:
+                found.append(os.path.join(root, name))
     logger.info(f"动态查找到的字体: {found}")
-    return found
+    return tuple(found)
 
 
-def get_font(size: int) -> ImageFont.FreeTypeFont:
-    """获取字体，优先使用系统中文字体"""
+def _resolve_font_paths() -> list:
+    """按优先级返回实际存在的候选字体路径"""
     # 优先使用自定义字体路径
     font_paths = []
-    if app_config.CUSTOM_FONT_PATH and Path(app_config.CUSTOM_FONT_PATH).exists():
+    if app_config.CUSTOM_FONT_PATH:
         font_paths.append(app_config.CUSTOM_FONT_PATH)
     font_paths.extend(CHINESE_FONT_PATHS)
     # 动态查找的字体作为后备
     font_paths.extend(_find_cjk_fonts())
+    return [font_path for font_path in font_paths if Path(font_path).exists()]
+
+
+# 模块加载时解析一次候选字体，避免每次请求重复扫描文件系统
+_FONT_CANDIDATES = _resolve_font_paths()
+_RESOLVED_FONT_PATH: Optional[str] = _FONT_CANDIDATES[0] if _FONT_CANDIDATES else None
+logger.info(f"候选字体: {_FONT_CANDIDATES}")
+
+# 已注册到 reportlab 的字体: 字体路径 -> 字体名称
+_PDF_FONTS: dict = {}
+_pdf_font_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=32)
+def get_font(size: int) -> ImageFont.FreeTypeFont:
+    """获取字体，优先使用系统中文字体（按字号缓存）"""
+    for font_path in _FONT_CANDIDATES:
+        try:
+            # .ttc文件需要指定字体索引
+            if font_path.lower().endswith('.ttc'):
+                font = ImageFont.truetype(font_path, size, index=0)
+            else:
+                font = ImageFont.truetype(font_path, size)
+            logger.info(f"成功加载字体: {font_path}, 字号: {size}")
+            return font
+        except Exception as e:
+            logger.error(f"加载字体失败 {font_path}: {e}")
+            continue
     
-    logger.info(f"尝试加载字体，候选列表: {font_paths}")
-    
-    for font_path in font_paths:
-        exists = Path(font_path).exists()
-        logger.info(f"检查字体: {font_path}, 存在: {exists}")
-        if exists:
+    # 降级使用默认字体
+    logger.warning("未找到中文字体，使用默认字体")
+    return ImageFont.load_default()
+
+
+def _ensure_pdf_font() -> str:
+    """注册PDF中文字体（每个进程只注册一次），返回可用的字体名称"""
+    with _pdf_font_lock:
+        if _PDF_FONTS:
+            return next(iter(_PDF_FONTS.values()))
+        
+        for font_path in _FONT_CANDIDATES:
             try:
-                # .ttc文件需要指定字体索引
+                # 生成唯一的字体名称
+                name = Path(font_path).stem.lower().replace(' ', '_')
+                
+                # .ttc文件需要特殊处理，使用subfontIndex
                 if font_path.lower().endswith('.ttc'):
-                    font = ImageFont.truetype(font_path, size, index=0)
+                    pdfmetrics.registerFont(TTFont(name, font_path, subfontIndex=0))
                 else:
-                    font = ImageFont.truetype(font_path, size)
-                logger.info(f"成功加载字体: {font_path}")
-                return font
-            except Exception as e:
-                logger.error(f"加载字体失败 {font_path}: {e}")
+                    pdfmetrics.registerFont(TTFont(name, font_path))
+                
+                _PDF_FONTS[font_path] = name
+                return name
+            except Exception:
                 continue
-    
-    # 降级使用默认字体
-    logger.warning("未找到中文字体，使用默认字体")
-    return ImageFont.load_default()
+        
+        # 没有可用的中文字体，缓存降级结果避免重复尝试
+        _PDF_FONTS[""] = "Helvetica"
+        return "Helvetica"
+
+
+def warm_up():
+    """预热字体缓存（用作工作进程的 initializer）"""
+    get_font(app_config.DEFAULT_WATERMARK_CONFIG["font_size"])
+    _ensure_pdf_font()
 
 
 class ImageWatermarker:
@@ -108,111 +195,197 @@ class ImageWatermarker:
     
     @staticmethod
     def add_watermark(
-        image_data: bytes,
+        image_data: FileSource,
         text: str,
         config: WatermarkConfig,
+        output: BinaryIO,
         output_format: str = "PNG"
-    ) -> bytes:
-        """为图片添加水印"""
+    ):
+        """为图片添加水印，结果写入 output"""
         # 打开图片
-        img = Image.open(io.BytesIO(image_data))
+        img = Image.open(_open_source(image_data))
         
-        # 转换为RGBA模式以支持透明度
-        if img.mode != "RGBA":
+        save_format = "JPEG" if output_format.upper() in ["JPEG", "JPG"] else output_format.upper()
+        # JPEG/BMP 不保留透明通道，直接在RGB底图上合成，省去RGBA往返转换
+        opaque_output = save_format in OPAQUE_IMAGE_FORMATS
+        
+        if opaque_output:
+            if img.mode != "RGB":
+                img = img.convert("RGB")
+        elif img.mode != "RGBA":
+            # 转换为RGBA模式以支持透明度
             img = img.convert("RGBA")
         
-        # 创建水印层
-        watermark_layer = Image.new("RGBA", img.size, (255, 255, 255, 0))
-        draw = ImageDraw.Draw(watermark_layer)
+        # 获取水印层（相同文字与配置的水印层会被缓存复用）
+        watermark_layer = ImageWatermarker._get_overlay(img.size, text, config)
         
+        # 合并图层
+        if opaque_output:
+            # 以水印层的透明通道为蒙版直接贴到RGB底图
+            img.paste(watermark_layer, (0, 0), watermark_layer)
+            result = img
+        else:
+            result = Image.alpha_composite(img, watermark_layer)
+        
+        # 保存到输出流
+        if save_format == "JPEG":
+            # 4:2:0 色度抽样 + 关闭优化/渐进式编码，显著提升编码速度并减小体积
+            result.save(
+                output, format=save_format, quality=app_config.JPEG_QUALITY,
+                subsampling=2, optimize=False, progressive=False
+            )
+        else:
+            result.save(output, format=save_format, quality=95)
+    
+    @staticmethod
+    def _get_overlay(
+        img_size: Tuple[int, int],
+        text: str,
+        config: WatermarkConfig
+    ) -> Image.Image:
+        """获取水印层，优先从缓存中读取（返回的图层不可修改）"""
+        if config.position == WatermarkPosition.TILE:
+            # 平铺水印与具体位置无关，按尺寸分档缓存后裁剪到原图大小
+            bucket = OVERLAY_SIZE_BUCKET
+            size = (
+                math.ceil(img_size[0] / bucket) * bucket,
+                math.ceil(img_size[1] / bucket) * bucket,
+            )
+        else:
+            size = img_size
+        
+        key = (
+            size, text, config.font_size, config.font_color, config.opacity,
+            config.angle, config.spacing, config.position
+        )
+        with _overlay_cache_lock:
+            overlay = _overlay_cache.get(key)
+            if overlay is not None:
+                _overlay_cache.move_to_end(key)
+        
+        if overlay is None:
+            overlay = ImageWatermarker._build_overlay(size, text, config)
+            ImageWatermarker._cache_overlay(key, overlay)
+        
+        if overlay.size != img_size:
+            left = (overlay.size[0] - img_size[0]) // 2
+            top = (overlay.size[1] - img_size[1]) // 2
+            overlay = overlay.crop((left, top, left + img_size[0], top + img_size[1]))
+        return overlay
+    
+    @staticmethod
+    def _cache_overlay(key: tuple, overlay: Image.Image):
+        """写入水印层缓存，超出容量时淘汰最久未使用的条目"""
+        global _overlay_cache_bytes
+        overlay_bytes = overlay.size[0] * overlay.size[1] * 4
+        if overlay_bytes > app_config.OVERLAY_CACHE_BYTES:
+            return
+        
+        with _overlay_cache_lock:
+            if key in _overlay_cache:
+                return
+            _overlay_cache[key] = overlay
+            _overlay_cache_bytes += overlay_bytes
+            while _overlay_cache_bytes > app_config.OVERLAY_CACHE_BYTES:
+                _, evicted = _overlay_cache.popitem(last=False)
+                _overlay_cache_bytes -= evicted.size[0] * evicted.size[1] * 4
+    
+    @staticmethod
+    def _build_overlay(
+        size: Tuple[int, int],
+        text: str,
+        config: WatermarkConfig
+    ) -> Image.Image:
+        """生成指定尺寸的水印层"""
         # 获取字体
         font = get_font(config.font_size)
         
         # 获取颜色
         color = hex_to_rgba(config.font_color, config.opacity)
         
-        # 获取文字大小
-        bbox = draw.textbbox((0, 0), text, font=font)
-        text_width = bbox[2] - bbox[0]
-        text_height = bbox[3] - bbox[1]
+        # 预先栅格化文字蒙版，蒙版尺寸即文字大小
+        mask = ImageWatermarker._render_text_mask(text, font)
+        text_width, text_height = mask.size
         
         if config.position == WatermarkPosition.TILE:
-            # 平铺水印 - 直接返回新的水印层
+            # 平铺水印
             watermark_layer = ImageWatermarker._create_tile_watermark(
-                img.size, text, font, color,
-                text_width, text_height, config.spacing, config.angle
+                size, mask, color, config.spacing, config.angle
             )
-        elif config.position == WatermarkPosition.CENTER:
-            # 居中水印
-            x = (img.size[0] - text_width) // 2
-            y = (img.size[1] - text_height) // 2
-            draw.text((x, y), text, font=font, fill=color)
         else:
-            # 角落水印
-            x, y = ImageWatermarker._get_corner_position(
-                img.size, text_width, text_height, config.position
-            )
-            draw.text((x, y), text, font=font, fill=color)
+            watermark_layer = Image.new("RGBA", size, (255, 255, 255, 0))
+            if config.position == WatermarkPosition.CENTER:
+                # 居中水印
+                x = (size[0] - text_width) // 2
+                y = (size[1] - text_height) // 2
+            else:
+                # 角落水印
+                x, y = ImageWatermarker._get_corner_position(
+                    size, text_width, text_height, config.position
+                )
+            watermark_layer.paste(color, (x, y), mask)
         
         # 旋转水印层（如果不是平铺模式）
         if config.position != WatermarkPosition.TILE and config.angle != 0:
             watermark_layer = watermark_layer.rotate(
-                config.angle, resample=Image.BICUBIC, expand=False
+                config.angle, resample=Image.Resampling.BILINEAR, expand=False
             )
         
-        # 合并图层
-        result = Image.alpha_composite(img, watermark_layer)
-        
-        # 如果原图是RGB模式，转换回RGB
-        if output_format.upper() in ["JPEG", "JPG"]:
-            result = result.convert("RGB")
-        
-        # 保存到字节流
-        output = io.BytesIO()
-        save_format = "JPEG" if output_format.upper() in ["JPEG", "JPG"] else output_format.upper()
-        result.save(output, format=save_format, quality=95)
-        return output.getvalue()
+        return watermark_layer
+    
+    @staticmethod
+    def _render_text_mask(text: str, font: ImageFont.FreeTypeFont) -> Image.Image:
+        """将文字栅格化为紧贴文字边界的灰度蒙版（支持多行文字）"""
+        # textbbox 对含换行的文字按多行测量，font.getbbox 只测量单行
+        left, top, right, bottom = ImageDraw.Draw(Image.new("L", (1, 1))).textbbox((0, 0), text, font=font)
+        mask = Image.new("L", (right - left, bottom - top), 0)
+        ImageDraw.Draw(mask).text((-left, -top), text, font=font, fill=255)
+        return mask
     
     @staticmethod
     def _create_tile_watermark(
         img_size: Tuple[int, int],
-        text: str,
-        font: ImageFont.FreeTypeFont,
+        mask: Image.Image,
         color: Tuple[int, int, int, int],
-        text_width: int,
-        text_height: int,
         spacing: int,
         angle: float
     ) -> Image.Image:
         """创建平铺水印层"""
-        # 计算旋转后需要覆盖的区域
-        diagonal = math.sqrt(img_size[0]**2 + img_size[1]**2)
-        
-        # 创建临时图层用于旋转
-        temp_size = int(diagonal * 1.5)
-        temp_layer = Image.new("RGBA", (temp_size, temp_size), (255, 255, 255, 0))
-        temp_draw = ImageDraw.Draw(temp_layer)
-        
+        width, height = img_size
+        text_width, text_height = mask.size
         step_x = text_width + spacing
         step_y = text_height + spacing
         
-        for y in range(0, temp_size, step_y):
-            for x in range(0, temp_size, step_x):
-                temp_draw.text((x, y), text, font=font, fill=color)
-        
-        # 旋转
-        temp_layer = temp_layer.rotate(angle, resample=Image.BICUBIC, expand=False)
-        
-        # 裁剪到原图大小
-        center_x = temp_size // 2
-        center_y = temp_size // 2
-        left = center_x - img_size[0] // 2
-        top = center_y - img_size[1] // 2
-        right = left + img_size[0]
-        bottom = top + img_size[1]
+        # 只旋转单个文字蒙版，而不是旋转整张平铺图层
+        rotated = mask.rotate(angle, resample=Image.Resampling.BILINEAR, expand=True)
+        half_w, half_h = rotated.size[0] / 2, rotated.size[1] / 2
+        
+        # 旋转后的平铺网格基向量（图像坐标系y轴向下，逆时针旋转）
+        rad = math.radians(angle)
+        cos_a, sin_a = math.cos(rad), math.sin(rad)
+        ux, uy = step_x * cos_a, -step_x * sin_a
+        vx, vy = step_y * sin_a, step_y * cos_a
+        
+        # 以图像中心为网格原点，求出覆盖图像（含文字外延）所需的网格索引范围
+        cx, cy = width / 2, height / 2
+        corners = [
+            (-half_w - cx, -half_h - cy), (width + half_w - cx, -half_h - cy),
+            (-half_w - cx, height + half_h - cy), (width + half_w - cx, height + half_h - cy),
+        ]
+        i_values = [(x * ux + y * uy) / (step_x * step_x) for x, y in corners]
+        j_values = [(x * vx + y * vy) / (step_y * step_y) for x, y in corners]
+        
+        layer = Image.new("RGBA", img_size, (255, 255, 255, 0))
+        for i in range(math.floor(min(i_values)), math.ceil(max(i_values)) + 1):
+            for j in range(math.floor(min(j_values)), math.ceil(max(j_values)) + 1):
+                x = cx + i * ux + j * vx
+                y = cy + i * uy + j * vy
+                # 跳过完全落在图像外的位置
+                if x + half_w < 0 or x - half_w > width or y + half_h < 0 or y - half_h > height:
+                    continue
+                layer.paste(color, (round(x - half_w), round(y - half_h)), rotated)
         
-        # 返回裁剪后的水印层
-        return temp_layer.crop((left, top, right, bottom))
+        return layer
     
     @staticmethod
     def _get_corner_position(
@@ -240,31 +413,77 @@ class PDFWatermarker:
     
     @staticmethod
     def add_watermark(
-        pdf_data: bytes,
+        pdf_data: FileSource,
         text: str,
-        config: WatermarkConfig
-    ) -> bytes:
-        """为PDF添加水印"""
-        # 创建水印PDF
-        watermark_pdf = PDFWatermarker._create_watermark_pdf(text, config)
+        config: WatermarkConfig,
+        output: BinaryIO
+    ):
+        """为PDF添加水印，结果写入 output"""
+        # 创建水印PDF（相同文字与配置复用缓存）
+        watermark_pdf = PDFWatermarker._get_watermark_pdf(text, config)
         
-        # 读取原PDF
-        reader = PdfReader(io.BytesIO(pdf_data))
-        writer = PdfWriter()
+        # 读取原PDF，整体克隆到writer中（保留书签、元数据等）
+        reader = PdfReader(_open_source(pdf_data))
+        writer = PdfWriter(clone_from=reader)
         
         # 读取水印PDF
         watermark_reader = PdfReader(io.BytesIO(watermark_pdf))
         watermark_page = watermark_reader.pages[0]
         
-        # 为每一页添加水印
-        for page in reader.pages:
+        # 直接在writer的页面上叠加水印
+        for page in writer.pages:
             page.merge_page(watermark_page)
-            writer.add_page(page)
         
         # 输出
-        output = io.BytesIO()
         writer.write(output)
-        return output.getvalue()
+    
+    @staticmethod
+    def add_watermark_to_pages(
+        pdf_data: FileSource,
+        text: str,
+        config: WatermarkConfig,
+        start: int,
+        stop: int,
+        output: BinaryIO
+    ):
+        """为PDF的 [start, stop) 页添加水印，仅输出这些页（用于分块并行处理）"""
+        watermark_pdf = PDFWatermarker._get_watermark_pdf(text, config)
+        watermark_page = PdfReader(io.BytesIO(watermark_pdf)).pages[0]
+        
+        reader = PdfReader(_open_source(pdf_data))
+        writer = PdfWriter()
+        for index in range(start, stop):
+            page = writer.add_page(reader.pages[index])
+            page.merge_page(watermark_page)
+        
+        writer.write(output)
+    
+    @staticmethod
+    def concat(parts: list, output: BinaryIO, metadata_source: Optional[FileSource] = None):
+        """
+        按顺序拼接多个PDF，可从原PDF复制元数据
+        原文件的书签、链接、命名目标与表单域不会保留
+        """
+        writer = PdfWriter()
+        for part in parts:
+            writer.append(str(part))
+        
+        if metadata_source is not None:
+            metadata = PdfReader(_open_source(metadata_source)).metadata
+            if metadata:
+                writer.add_metadata(metadata)
+        
+        # 各分块各自携带一份共享资源（图片、字体、水印等），拼接后合并相同对象
+        writer.compress_identical_objects(remove_duplicates=True, remove_unreferenced=True)
+        writer.write(output)
+    
+    @staticmethod
+    def _get_watermark_pdf(text: str, config: WatermarkConfig) -> bytes:
+        """获取水印PDF，相同文字与配置只生成一次"""
+        return _create_watermark_pdf_cached(
+            text, config.font_size, config.font_color, config.opacity,
+            config.angle, config.spacing, config.position.value
+        )
     
     @staticmethod
     def _create_watermark_pdf(text: str, config: WatermarkConfig) -> bytes:
@@ -281,34 +500,7 @@ class PDFWatermarker:
         c.setFillColorRGB(r/255, g/255, b/255)
         
         # 注册中文字体
-        font_name = "Helvetica"
-        font_registered = False
-        
-        # 优先使用自定义字体路径
-        font_paths = []
-        if app_config.CUSTOM_FONT_PATH and Path(app_config.CUSTOM_FONT_PATH).exists():
-            font_paths.append(app_config.CUSTOM_FONT_PATH)
-        font_paths.extend(CHINESE_FONT_PATHS)
-        font_paths.extend(_find_cjk_fonts())
-        
-        for font_path in font_paths:
-            if Path(font_path).exists() and not font_registered:
-                try:
-                    # 生成唯一的字体名称
-                    path_obj = Path(font_path)
-                    name = path_obj.stem.lower().replace(' ', '_')
-                    
-                    # .ttc文件需要特殊处理，使用subfontIndex
-                    if font_path.lower().endswith('.ttc'):
-                        pdfmetrics.registerFont(TTFont(name, font_path, subfontIndex=0))
-                    else:
-                        pdfmetrics.registerFont(TTFont(name, font_path))
-                    
-                    font_name = name
-                    font_registered = True
-                    break
-                except Exception:
-                    continue
+        font_name = _ensure_pdf_font()
         
         c.setFont(font_name, config.font_size)
         
@@ -361,6 +553,28 @@ class PDFWatermarker:
         return positions.get(position, (margin, margin))
 
 
+@functools.lru_cache(maxsize=128)
+def _create_watermark_pdf_cached(
+    text: str,
+    font_size: int,
+    font_color: str,
+    opacity: float,
+    angle: float,
+    spacing: int,
+    position: str
+) -> bytes:
+    """按文字与配置字段缓存水印PDF"""
+    config = WatermarkConfig(
+        font_size=font_size,
+        font_color=font_color,
+        opacity=opacity,
+        angle=angle,
+        spacing=spacing,
+        position=WatermarkPosition(position)
+    )
+    return PDFWatermarker._create_watermark_pdf(text, config)
+
+
 class WordWatermarker:
     """Word文档水印处理器"""
     
@@ -373,21 +587,20 @@ class WordWatermarker:
     
     @staticmethod
     def add_watermark(
-        docx_data: bytes,
+        docx_data: FileSource,
         text: str,
-        config: WatermarkConfig
-    ) -> bytes:
-        """为Word文档添加水印"""
+        config: WatermarkConfig,
+        output: BinaryIO
+    ):
+        """为Word文档添加水印，结果写入 output"""
         try:
-            doc = Document(io.BytesIO(docx_data))
+            doc = Document(_open_source(docx_data))
             
             # 为每个section添加水印
             for section in doc.sections:
                 WordWatermarker._add_watermark_to_section(section, text, config)
             
-            output = io.BytesIO()
             doc.save(output)
-            return output.getvalue()
         except Exception as e:
             logger.error(f"Word水印处理失败: {e}")
             raise
@@ -438,48 +651,164 @@ class WordWatermarker:
         run._element.append(pict)
 
 
-def add_watermark(
-    file_data: bytes,
+def write_watermark(
+    file_data: FileSource,
     text: str,
     file_type: str,
+    output: BinaryIO,
     config: Optional[WatermarkConfig] = None,
     file_extension: str = ".png"
-) -> bytes:
+):
     """
-    统一的水印添加接口
+    统一的水印处理接口，结果写入输出流
     
     Args:
-        file_data: 文件二进制数据
+        file_data: 文件二进制数据或文件路径
         text: 水印文字
         file_type: 文件类型 (image/pdf/word)
+        output: 输出流
         config: 水印配置
         file_extension: 文件扩展名（用于图片格式判断）
-    
-    Returns:
-        添加水印后的文件二进制数据
     """
     if config is None:
         config = WatermarkConfig()
     
     if file_type == "image":
         # 根据扩展名确定输出格式
-        format_map = {
-            ".jpg": "JPEG",
-            ".jpeg": "JPEG",
-            ".png": "PNG",
-            ".gif": "GIF",
-            ".bmp": "BMP",
-            ".webp": "WEBP",
-            ".tiff": "TIFF",
-        }
-        output_format = format_map.get(file_extension.lower(), "PNG")
-        return ImageWatermarker.add_watermark(file_data, text, config, output_format)
+        output_format = _IMG_FORMAT_BY_EXT.get(file_extension.lower(), "PNG")
+        ImageWatermarker.add_watermark(file_data, text, config, output, output_format)
     
     elif file_type == "pdf":
-        return PDFWatermarker.add_watermark(file_data, text, config)
+        PDFWatermarker.add_watermark(file_data, text, config, output)
     
     elif file_type == "word":
-        return WordWatermarker.add_watermark(file_data, text, config)
+        WordWatermarker.add_watermark(file_data, text, config, output)
     
     else:
         raise ValueError(f"Unsupported file type: {file_type}")
+
+
+def add_watermark(
+    file_data: FileSource,
+    text: str,
+    file_type: str,
+    config: Optional[WatermarkConfig] = None,
+    file_extension: str = ".png"
+) -> bytes:
+    """
+    统一的水印添加接口
+    
+    Args:
+        file_data: 文件二进制数据或文件路径
+        text: 水印文字
+        file_type: 文件类型 (image/pdf/word)
+        config: 水印配置
+        file_extension: 文件扩展名（用于图片格式判断）
+    
+    Returns:
+        添加水印后的文件二进制数据
+    """
+    output = io.BytesIO()
+    write_watermark(file_data, text, file_type, output, config, file_extension)
+    return output.getvalue()
+
+
+@contextmanager
+def _atomic_output(output_path: Path):
+    """
+    打开输出文件用于写入
+    先写入同目录下的临时文件，成功后再原子替换为目标文件，避免产生不完整的输出
+    """
+    part_path = output_path.with_name(f".{output_path.name}.part")
+    try:
+        with open(part_path, "wb") as output:
+            yield output
+        os.replace(part_path, output_path)
+    except BaseException:
+        part_path.unlink(missing_ok=True)
+        raise
+
+
+def add_watermark_to_file(
+    file_data: FileSource,
+    text: str,
+    file_type: str,
+    output_path: Path,
+    config: Optional[WatermarkConfig] = None,
+    file_extension: str = ".png"
+) -> Path:
+    """
+    添加水印并直接写入文件
+    
+    Returns:
+        输出文件路径
+    """
+    with _atomic_output(output_path) as output:
+        write_watermark(file_data, text, file_type, output, config, file_extension)
+    return output_path
+
+
+def process_watermark_sync(
+    file_data: FileSource,
+    text: str,
+    file_type: str,
+    file_extension: str,
+    watermark_config: dict,
+    output_path: Path
+) -> Path:
+    """同步处理水印并写入输出文件（在进程池中执行，参数需可序列化）"""
+    return add_watermark_to_file(
+        file_data=file_data,
+        text=text,
+        file_type=file_type,
+        output_path=output_path,
+        config=WatermarkConfig(**watermark_config),
+        file_extension=file_extension
+    )
+
+
+def count_pdf_pages(pdf_data: FileSource) -> int:
+    """获取PDF页数"""
+    return len(PdfReader(_open_source(pdf_data)).pages)
+
+
+def add_pdf_watermark_pages_to_file(
+    pdf_data: FileSource,
+    text: str,
+    start: int,
+    stop: int,
+    output_path: Path,
+    config: Optional[WatermarkConfig] = None
+) -> Path:
+    """为PDF的 [start, stop) 页添加水印并写入文件（分块并行处理的单个分块）"""
+    if config is None:
+        config = WatermarkConfig()
+    
+    with _atomic_output(output_path) as output:
+        PDFWatermarker.add_watermark_to_pages(pdf_data, text, config, start, stop, output)
+    return output_path
+
+
+def process_pdf_chunk_sync(
+    file_data: FileSource,
+    text: str,
+    start: int,
+    stop: int,
+    output_path: Path,
+    watermark_config: dict
+) -> Path:
+    """处理单个PDF分块（在进程池中执行，参数需可序列化）"""
+    return add_pdf_watermark_pages_to_file(
+        file_data, text, start, stop, output_path, WatermarkConfig(**watermark_config)
+    )
+
+
+def concat_pdf_files(
+    parts: list,
+    output_path: Path,
+    metadata_source: Optional[FileSource] = None
+) -> Path:
+    """按顺序拼接分块PDF并写入文件"""
+    with _atomic_output(output_path) as output:
+        PDFWatermarker.concat(parts, output, metadata_source)
+    return output_path
@@ -2,30 +2,108 @@
 文件处理工具
 """
 import os
-import uuid
+import time
+import errno
+import shutil
+import asyncio
+import threading
+import functools
 import httpx
+import aiofiles
 import mimetypes
 from pathlib import Path
-from typing import Tuple, Optional
+from secrets import token_hex, token_urlsafe
+from typing import List, Tuple, Optional, Union
 
 import config
 import re
 from urllib.parse import urlparse, unquote
 
 
+# Content-Disposition 文件名解析（预编译，字符类锚定避免回溯）
+_RFC5987_RE = re.compile(r"filename\*\s*=\s*([\w-]+)'[^']*'([^;]+)", re.IGNORECASE)
+_QUOTED_RE = re.compile(r"""filename\s*=\s*(?:"([^"]*)"|'([^']*)'|([^;\s]+))""", re.IGNORECASE)
+
+_WORD_EXTS = frozenset({".docx", ".doc"})
+
+# 常见 Content-Type 到扩展名的映射，未命中时再回退到 mimetypes
+_CT_TO_EXT = {
+    "image/jpeg": ".jpg",
+    "image/jpg": ".jpg",
+    "image/pjpeg": ".jpg",
+    "image/png": ".png",
+    "image/gif": ".gif",
+    "image/bmp": ".bmp",
+    "image/x-ms-bmp": ".bmp",
+    "image/webp": ".webp",
+    "image/tiff": ".tiff",
+    "application/pdf": ".pdf",
+    "application/msword": ".doc",
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document": ".docx",
+}
+
+# 共享的HTTP客户端（复用连接池与TLS会话，启用HTTP/2多路复用）
+_CLIENT: Optional[httpx.AsyncClient] = None
+_CLIENT_LOCK = asyncio.Lock()
+
+
+async def get_client() -> httpx.AsyncClient:
+    """获取共享的HTTP客户端，首次调用时创建"""
+    global _CLIENT
+    if _CLIENT is None:
+        async with _CLIENT_LOCK:
+            if _CLIENT is None:
+                _CLIENT = httpx.AsyncClient(
+                    http2=True,
+                    limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+                    timeout=60.0,
+                    follow_redirects=True,
+                    headers={"Accept-Encoding": "gzip, br"}
+                )
+    return _CLIENT
+
+
+async def close_client():
+    """关闭共享的HTTP客户端（应用退出时调用）"""
+    global _CLIENT
+    if _CLIENT is not None:
+        await _CLIENT.aclose()
+        _CLIENT = None
+
+
+def _new_temp_path(suffix: str) -> Path:
+    """生成临时文件路径，按名称前两位分片: TEMP_DIR/ab/ab12...{suffix}"""
+    name = token_hex(16)
+    return config.TEMP_DIR / name[:2] / f"{name}{suffix}"
+
+
+def _path_name(filename: str) -> str:
+    """取路径最后一段，与 Path.name 规则一致（忽略末尾的 / 与 . 路径段）"""
+    if "/" not in filename:
+        return "" if filename == "." else filename
+    parts = [part for part in filename.split("/") if part and part != "."]
+    return parts[-1] if parts else ""
+
+
+def _split_suffix(name: str) -> Tuple[str, str]:
+    """拆分文件名为 (主名, 扩展名)，与 Path.stem/Path.suffix 规则一致：隐藏文件与以点结尾的名称无扩展名"""
+    i = name.rfind(".")
+    if 0 < i < len(name) - 1:
+        return name[:i], name[i:]
+    return name, ""
+
+
 def get_file_extension(filename: str) -> str:
-    """获取文件扩展名"""
-    return Path(filename).suffix.lower()
+    """获取文件扩展名（小写）"""
+    return _split_suffix(_path_name(filename))[1].lower()
 
 
 def get_extension_from_content_type(content_type: str) -> str:
     """从Content-Type获取扩展名"""
-    ext = mimetypes.guess_extension(content_type)
-    if ext == ".jpe":
-        ext = ".jpg"
-    return ext or ""
+    return _CT_TO_EXT.get(content_type.strip().lower(), "") or (mimetypes.guess_extension(content_type) or "")
 
 
+@functools.lru_cache(maxsize=32)
 def detect_file_type(extension: str) -> str:
     """根据扩展名检测文件类型"""
     ext = extension.lower()
@@ -33,19 +111,19 @@ def detect_file_type(extension: str) -> str:
         return "image"
     elif ext == ".pdf":
         return "pdf"
-    elif ext in {".docx", ".doc"}:
+    elif ext in _WORD_EXTS:
         return "word"
     return "unknown"
 
 
 def generate_output_filename(original_filename: str) -> str:
     """生成输出文件名"""
-    ext = get_file_extension(original_filename)
-    unique_id = uuid.uuid4().hex[:8]
-    base_name = Path(original_filename).stem
-    return f"{base_name}_watermarked_{unique_id}{ext}"
+    # 去掉目录部分，避免输出路径越出输出目录
+    base_name, ext = _split_suffix(_path_name(original_filename))
+    return f"{base_name}_watermarked_{token_urlsafe(6)}{ext.lower()}"
 
 
+@functools.lru_cache(maxsize=256)
 def parse_content_disposition(content_disposition: str) -> Optional[str]:
     """
     解析Content-Disposition header获取文件名
@@ -55,19 +133,19 @@ def parse_content_disposition(content_disposition: str) -> Optional[str]:
         return None
     
     # 优先解析 filename*=UTF-8''encoded_name 格式 (RFC 5987)
-    match = re.search(r"filename\*\s*=\s*([^']+)'[^']*'(.+?)(?:;|$)", content_disposition, re.IGNORECASE)
+    match = _RFC5987_RE.search(content_disposition)
     if match:
         encoding = match.group(1).lower()
-        encoded_name = match.group(2)
+        encoded_name = match.group(2).strip()
         try:
-            return unquote(encoded_name, encoding=encoding if encoding else 'utf-8')
+            return unquote(encoded_name, encoding=encoding)
         except Exception:
             pass
     
-    # 解析 filename="name" 或 filename=name 格式
-    match = re.search(r'filename\s*=\s*["\']?([^"\'\s;]+)["\']?', content_disposition, re.IGNORECASE)
+    # 解析 filename="name"、filename='name' 或 filename=name 格式
+    match = _QUOTED_RE.search(content_disposition)
     if match:
-        return match.group(1)
+        return match.group(1) or match.group(2) or match.group(3) or None
     
     return None
 
@@ -76,10 +154,16 @@ def extract_filename_from_url(url: str) -> Optional[str]:
     """
     从URL路径中提取文件名
     """
+    # 快速路径：无转义、查询串与片段时直接截取最后一段路径
+    if not any(c in url for c in "%?#;"):
+        _, sep, path = url.partition("://")[2].partition("/")
+        filename = path.rsplit("/", 1)[-1] if sep else ""
+        return filename if "." in filename and len(filename) > 2 else None
+    
     try:
         parsed = urlparse(url)
         path = unquote(parsed.path)  # URL解码
-        filename = Path(path).name
+        filename = path.rsplit("/", 1)[-1]
         # 检查是否是有效文件名（有扩展名）
         if filename and "." in filename and len(filename) > 2:
             return filename
@@ -88,21 +172,34 @@ def extract_filename_from_url(url: str) -> Optional[str]:
     return None
 
 
-async def download_file(url: str) -> Tuple[bytes, str, str]:
+class FileTooLargeError(Exception):
+    """文件大小超过限制"""
+
+
+async def download_file(url: str, chunk_size: int = 1 << 20) -> Tuple[Path, str, str]:
     """
-    从URL下载文件
-    返回: (文件内容, 原始文件名, 扩展名)
+    从URL下载文件，响应内容分块直接写入临时文件
+    超过 config.MAX_DOWNLOAD_BYTES 时中止下载并抛出 FileTooLargeError
+    返回: (临时文件路径, 原始文件名, 扩展名)
     """
-    async with httpx.AsyncClient(timeout=60.0, follow_redirects=True) as client:
-        response = await client.get(url)
+    max_bytes = config.MAX_DOWNLOAD_BYTES
+    client = await get_client()
+    async with client.stream("GET", url) as response:
         response.raise_for_status()
         
-        content = response.content
-        filename = None
+        headers = response.headers
+        
+        # 声明的大小已超限时不再下载
+        try:
+            content_length = int(headers.get("content-length") or 0)
+        except ValueError:
+            content_length = 0
+        if content_length > max_bytes:
+            raise FileTooLargeError(f"文件大小超过限制: {max_bytes}")
+        content_type = headers.get("content-type", "").split(";", 1)[0].strip().lower()
         
         # 1. 优先从Content-Disposition获取文件名（最可靠）
-        content_disposition = response.headers.get("content-disposition", "")
-        filename = parse_content_disposition(content_disposition)
+        filename = parse_content_disposition(headers.get("content-disposition", ""))
         
         # 2. 尝试从URL路径获取文件名
         if not filename:
@@ -110,34 +207,114 @@ async def download_file(url: str) -> Tuple[bytes, str, str]:
         
         # 3. 根据Content-Type生成文件名
         if not filename:
-            content_type = response.headers.get("content-type", "")
-            extension = get_extension_from_content_type(content_type.split(";")[0])
-            filename = f"file_{uuid.uuid4().hex[:8]}{extension}"
+            extension = get_extension_from_content_type(content_type)
+            filename = f"file_{token_urlsafe(6)}{extension}"
         
         # 获取扩展名
         extension = get_file_extension(filename)
         
         # 如果没有扩展名，尝试从Content-Type补充
         if not extension:
-            content_type = response.headers.get("content-type", "")
-            extension = get_extension_from_content_type(content_type.split(";")[0])
+            extension = get_extension_from_content_type(content_type)
             if extension:
                 filename = f"{filename}{extension}"
         
-        return content, filename, extension
+        # 边接收边写入临时文件
+        temp_path = _new_temp_path(extension)
+        written = 0
+        try:
+            async with aiofiles.open(temp_path, "wb") as f:
+                async for chunk in response.aiter_bytes(chunk_size=chunk_size):
+                    written += len(chunk)
+                    if written > max_bytes:
+                        raise FileTooLargeError(f"文件大小超过限制: {max_bytes}")
+                    await f.write(chunk)
+        except BaseException:
+            temp_path.unlink(missing_ok=True)
+            raise
+    
+    return temp_path, filename, extension
 
 
-def save_temp_file(content: bytes, filename: str) -> Path:
-    """保存临时文件"""
-    temp_path = config.TEMP_DIR / f"{uuid.uuid4().hex}_{filename}"
-    temp_path.write_bytes(content)
+async def download_files(urls: List[str], concurrency: int = 8) -> List[Union[Tuple[Path, str, str], BaseException]]:
+    """
+    并发下载多个URL
+    concurrency: 同时进行的下载数上限（批量大小）
+    返回: 与urls顺序一致的结果列表，失败项为对应的异常对象
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    
+    async def _download_one(url: str):
+        async with semaphore:
+            return await download_file(url)
+    
+    return await asyncio.gather(*(_download_one(url) for url in urls), return_exceptions=True)
+
+
+async def save_upload_to_temp(upload, extension: str, chunk_size: int = 1 << 20) -> Path:
+    """
+    将上传文件分块写入临时目录，边写边检查大小
+    超过 config.MAX_FILE_SIZE 时删除临时文件并抛出 FileTooLargeError
+    """
+    temp_path = _new_temp_path(extension)
+    total = 0
+    try:
+        async with aiofiles.open(temp_path, "wb") as f:
+            while chunk := await upload.read(chunk_size):
+                total += len(chunk)
+                if total > config.MAX_FILE_SIZE:
+                    raise FileTooLargeError(f"文件大小超过限制: {config.MAX_FILE_SIZE}")
+                await f.write(chunk)
+    except BaseException:
+        temp_path.unlink(missing_ok=True)
+        raise
     return temp_path
 
 
-def save_output_file(content: bytes, filename: str) -> Path:
-    """保存输出文件"""
+async def _write_chunked(path: Path, content: Union[bytes, memoryview], chunk_size: int = 1 << 20):
+    """按块写入文件（memoryview 切片不复制数据）"""
+    view = memoryview(content)
+    async with aiofiles.open(path, "wb", buffering=chunk_size) as f:
+        for i in range(0, len(view), chunk_size):
+            await f.write(view[i:i + chunk_size])
+
+
+async def save_temp_file(content: Union[bytes, memoryview], filename: str) -> Path:
+    """保存临时文件（分块异步写入）"""
+    temp_path = _new_temp_path(f"_{filename}")
+    await _write_chunked(temp_path, content)
+    return temp_path
+
+
+async def save_output_file(content: Union[bytes, memoryview], filename: str) -> Path:
+    """保存输出文件（分块异步写入）"""
     output_path = config.OUTPUT_DIR / filename
-    output_path.write_bytes(content)
+    await _write_chunked(output_path, content)
+    return output_path
+
+
+def save_output_from_path(src: Path, filename: str) -> Path:
+    """
+    将已落盘的文件移入输出目录（src 会被移走）
+    同一文件系统下直接重命名；跨文件系统时（如输出目录为单独挂载的卷）
+    由 shutil.copyfile 在内核中复制（sendfile）到同目录临时文件，完成后再原子替换，避免下载到不完整的文件
+    """
+    output_path = config.OUTPUT_DIR / filename
+    try:
+        os.replace(src, output_path)
+        return output_path
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    
+    part_path = output_path.with_name(f".{output_path.name}.part")
+    try:
+        shutil.copyfile(src, part_path)
+        os.replace(part_path, output_path)
+    except BaseException:
+        part_path.unlink(missing_ok=True)
+        raise
+    os.unlink(src)
     return output_path
 
 
@@ -146,19 +323,38 @@ def get_download_url(filename: str) -> str:
     return f"{config.DOWNLOAD_URL_PREFIX}/{filename}"
 
 
-def cleanup_old_files():
-    """清理过期文件"""
-    import time
-    current_time = time.time()
-    
-    for directory in [config.OUTPUT_DIR, config.TEMP_DIR]:
-        if not directory.exists():
-            continue
-        for file_path in directory.iterdir():
-            if file_path.is_file():
-                file_age = current_time - file_path.stat().st_mtime
-                if file_age > config.FILE_RETENTION_SECONDS:
-                    try:
-                        file_path.unlink()
-                    except Exception:
-                        pass
+_cleanup_lock = threading.Lock()
+
+
+def _cleanup_dir(directory: Path, current_time: float):
+    """清理目录（含分片子目录）中的过期文件"""
+    if not directory.exists():
+        return
+    retention = config.FILE_RETENTION_SECONDS
+    # scandir 的 DirEntry 自带 stat 缓存，避免逐个构建 Path 并重复 stat
+    with os.scandir(directory) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                _cleanup_dir(Path(entry.path), current_time)
+                continue
+            if not entry.is_file(follow_symlinks=False):
+                continue
+            try:
+                if current_time - entry.stat(follow_symlinks=False).st_mtime > retention:
+                    os.unlink(entry.path)
+            except OSError:
+                pass
+
+
+async def cleanup_old_files():
+    """清理过期文件（各目录在线程中并发扫描，上一次清理未结束时直接跳过）"""
+    if not _cleanup_lock.acquire(blocking=False):
+        return
+    try:
+        current_time = time.time()
+        await asyncio.gather(*(
+            asyncio.to_thread(_cleanup_dir, directory, current_time)
+            for directory in (config.OUTPUT_DIR, config.TEMP_DIR)
+        ))
+    finally:
+        _cleanup_lock.release()
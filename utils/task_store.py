@@ -0,0 +1,116 @@
+"""
+异步任务状态存储
+基于 SQLite，多个 uvicorn worker 进程共享同一份任务状态
+方法均为同步阻塞调用，在事件循环中应通过 asyncio.to_thread 调用
+"""
+import time
+import sqlite3
+from pathlib import Path
+from contextlib import contextmanager
+from typing import Optional
+
+from models import TaskStatus
+
+
+class TaskStore:
+    """任务状态存储（带过期清理与数量上限）"""
+    
+    def __init__(
+        self,
+        db_path: Path,
+        ttl_seconds: int,
+        max_tasks: int,
+        stale_seconds: Optional[int] = None
+    ):
+        self.db_path = db_path
+        self.ttl_seconds = ttl_seconds
+        self.max_tasks = max_tasks
+        # 未结束的任务超过该时间仍未完成时视为失效（如处理进程被重启或终止），默认为保留时间的两倍
+        self.stale_seconds = stale_seconds if stale_seconds is not None else ttl_seconds * 2
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS tasks ("
+                " task_id TEXT PRIMARY KEY,"
+                " status TEXT NOT NULL,"
+                " message TEXT NOT NULL,"
+                " download_url TEXT,"
+                " created REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_tasks_created ON tasks (created)")
+    
+    @contextmanager
+    def _connect(self):
+        """每次操作使用独立连接（自动提交并关闭），可在多线程/多进程中安全使用"""
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+    
+    def create(self, task_id: str, status: TaskStatus, message: str):
+        """创建任务（数量上限在 cleanup_expired 中统一处理）"""
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO tasks (task_id, status, message, download_url, created)"
+                " VALUES (?, ?, ?, NULL, ?)",
+                (task_id, status.value, message, time.time())
+            )
+    
+    def update(
+        self,
+        task_id: str,
+        status: TaskStatus,
+        message: str,
+        download_url: Optional[str] = None
+    ):
+        """更新任务状态"""
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE tasks SET status = ?, message = ?, download_url = ? WHERE task_id = ?",
+                (status.value, message, download_url, task_id)
+            )
+    
+    def get(self, task_id: str) -> Optional[dict]:
+        """查询任务状态，不存在时返回 None"""
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT status, message, download_url FROM tasks WHERE task_id = ?",
+                (task_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {
+            "status": TaskStatus(row[0]),
+            "message": row[1],
+            "download_url": row[2],
+        }
+    
+    def cleanup_expired(self):
+        """
+        清理已结束且超过保留时间的任务记录，以及长时间未结束的失效任务
+        记录数仍超过上限时，优先淘汰最早的已结束任务，其次才淘汰最早的未结束任务
+        """
+        finished = (TaskStatus.COMPLETED.value, TaskStatus.FAILED.value)
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "DELETE FROM tasks WHERE (status IN (?, ?) AND created < ?) OR created < ?",
+                (*finished, now - self.ttl_seconds, now - self.stale_seconds)
+            )
+            
+            excess = conn.execute("SELECT COUNT(*) FROM tasks").fetchone()[0] - self.max_tasks
+            if excess <= 0:
+                return
+            excess -= conn.execute(
+                "DELETE FROM tasks WHERE task_id IN ("
+                " SELECT task_id FROM tasks WHERE status IN (?, ?) ORDER BY created LIMIT ?)",
+                (*finished, excess)
+            ).rowcount
+            if excess > 0:
+                conn.execute(
+                    "DELETE FROM tasks WHERE task_id IN ("
+                    " SELECT task_id FROM tasks ORDER BY created LIMIT ?)",
+                    (excess,)
+                )